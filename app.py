@@ -1,276 +1,475 @@
 import os
-import re
+import atexit
 import datetime
-import json
+import gc
+import hashlib
+import shutil
+import tempfile
+import threading
+import zipfile
 from io import BytesIO
+from collections import OrderedDict, deque
+from itertools import islice
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import streamlit as st
-from PIL import Image
 
-import vertexai
-from vertexai.generative_models import GenerativeModel, Part
 from google.oauth2 import service_account
+from google.api_core import retry
+from google.api_core.exceptions import InternalServerError, InvalidArgument, ResourceExhausted, ServiceUnavailable
+
+from gemini_io import first_inline, first_text, inline_per_candidate, is_truncated, safe_get_enhanced_text, sniff_mime, to_png
+from prompts import RAW_TEMPLATES, REFINEMENT_PARTS, STYLE_DESCRIPTIONS, STYLE_HINT
 
 # ---------------- CONFIG ----------------
 PROJECT_ID = st.secrets["gcp_service_account"]["project_id"]
-
-# Create credentials from secrets
-credentials = service_account.Credentials.from_service_account_info(
-    dict(st.secrets["gcp_service_account"])
-)
-
-# Init Vertex AI (global required for Nano Banana)
-vertexai.init(project=PROJECT_ID, location="global", credentials=credentials)
-
-# Models
-IMAGE_MODEL = GenerativeModel("gemini-2.5-flash-image")  # Nano Banana
-TEXT_MODEL = GenerativeModel("gemini-2.0-flash")  # Prompt refinement
+CACHE_TTL = 24 * 60 * 60  # seconds to keep cached Gemini responses
+PREVIEW_MAX_PX = 1024  # long edge of the previews sent to the browser
+COLUMN_PREVIEW_MAX_PX = 512  # previews that are only ever shown in side-by-side columns
+HISTORY_LIMIT = 20  # entries kept per history list
+UPLOAD_MAX_PX = 1536  # long edge uploads are clamped to before editing
+HISTORY_PAGE_SIZE = 5  # history entries rendered per "Load more" page
+IMAGE_DIR_MAX_BYTES = int(os.getenv("IMAGE_DIR_MAX_MB", "1024")) * 1024 * 1024  # disk cap for stored images
+
+# Selectbox options, built once instead of on every rerun
+_DEPT_OPTS = tuple(RAW_TEMPLATES)
+_STYLE_OPTS = tuple(STYLE_DESCRIPTIONS)
+
+
+@st.cache_resource
+def get_credentials():
+    """Build service account credentials from secrets once per process"""
+    return service_account.Credentials.from_service_account_info(
+        dict(st.secrets["gcp_service_account"])
+    )
+
+
+@st.cache_resource
+def get_models():
+    """Init Vertex AI once per process and return (image_model, text_model)"""
+    # Imported here so the first page render does not wait on the Vertex SDK import
+    import vertexai
+    from vertexai.generative_models import GenerativeModel
+
+    # Init Vertex AI (global required for Nano Banana)
+    vertexai.init(project=PROJECT_ID, location="global", credentials=get_credentials())
+    return (
+        GenerativeModel("gemini-2.5-flash-image"),  # Nano Banana
+        GenerativeModel("gemini-2.0-flash"),  # Prompt refinement
+    )
 
 # ---------------- STREAMLIT UI ----------------
 st.set_page_config(page_title="AI Image Generator + Editor", layout="wide")
 st.title("🖼️ AI Image Generator + Editor")
+st.checkbox("💾 Download as PNG (lossless, larger files)", key="download_png")
 
 # ---------------- STATE ----------------
+# Bounded so old entries are dropped instead of accumulating for the whole session.
+# Entries keep only small WEBP previews in memory; full images live on disk (store_image).
 if "generated_images" not in st.session_state:
-    st.session_state.generated_images = []  # [{"filename","content"}]
+    st.session_state.generated_images = deque(maxlen=HISTORY_LIMIT)  # [{"filename","path","hash","display"}]
 if "edited_images" not in st.session_state:
-    st.session_state.edited_images = []  # [{"original","edited","prompt"}]
-
-# ---------------- Prompt Templates ----------------
-PROMPT_TEMPLATES = {
-    
-    "None": """
-Dont make any changes in the user's prompt.Follow it as it is
-User’s raw prompt:
-"{USER_PROMPT}"
-
-Refined general image prompt:
-""",
-    
-    "Marketing": """
-You are a senior AI prompt engineer creating polished prompts for marketing and advertising visuals.
-
-Task:
-- Take the user’s raw input and turn it into a polished, professional, campaign-ready image prompt.
-- Expand the idea with rich marketing-oriented details that make it visually persuasive.
-
-When refining, include:
-- Background & setting (modern, lifestyle, commercial, aspirational)
-- Lighting & atmosphere (studio lights, golden hour, cinematic)
-- Style (photorealistic, cinematic, product photography, lifestyle branding)
-- Perspective & composition (wide shot, close-up, dramatic angles)
-- Mood, tone & branding suitability (premium, sleek, aspirational)
-
-Special Brand Rule:
-- If the user asks for an image related to a specific brand, seamlessly add the brand’s tagline into the final image prompt.
-- For **Dr. Reddy’s**, the correct tagline is: “Good Health Can’t Wait.”
-
-Rules:
-- Stay faithful to the user’s idea but elevate it for use in ads, social media, or presentations.
-- Output **only** the final refined image prompt (no explanations, no extra text).
-
-User raw input:
-{USER_PROMPT}
-
-
-Refined marketing image prompt:
-""",
-
-    "Design": """
-You are a senior AI prompt engineer supporting a creative design team.
-
-Your job:
-- Expand raw input into a visually inspiring, design-oriented image prompt.
-- Add imaginative details about:
-  • Artistic styles (minimalist, abstract, futuristic, flat, 3D render, watercolor, digital illustration)
-  • Color schemes, palettes, textures, and patterns
-  • Composition and balance (symmetry, negative space, creative framing)
-  • Lighting and atmosphere (soft glow, vibrant contrast, surreal shading)
-  • Perspective (isometric, top-down, wide shot, close-up)
-
-Rules:
-- Keep fidelity to the idea but make it highly creative and visually unique.
-- Output only the final refined image prompt.
-
-User’s raw prompt:
-"{USER_PROMPT}"
-
-Refined design image prompt:
-""",
-
-    "General": """
-You are an expert AI prompt engineer specialized in creating vivid and descriptive image prompts.
-
-Your job:
-- Expand the user’s input into a detailed, clear prompt for an image generation model.
-- Add missing details such as:
-  • Background and setting
-  • Lighting and mood
-  • Style and realism level
-  • Perspective and composition
-
-Rules:
-- Stay true to the user’s intent.
-- Keep language concise, descriptive, and expressive.
-- Output only the final refined image prompt.
-
-User’s raw prompt:
-"{USER_PROMPT}"
-
-Refined general image prompt:
-""",
-
-    "DPEX": """
-You are a senior AI prompt engineer creating refined prompts for IT and technology-related visuals.
-
-Your job:
-- Transform the raw input into a detailed, professional, and technology-focused image prompt.
-- Expand with contextual details about:
-  • Technology environments (server rooms, data centers, cloud systems, coding workspaces)
-  • Digital elements (network diagrams, futuristic UIs, holograms, cybersecurity visuals)
-  • People in IT roles (developers, engineers, admins, tech support, collaboration)
-  • Tone (innovative, technical, futuristic, professional)
-  • Composition (screens, servers, code on monitors, abstract digital patterns)
-  • Lighting and effects (LED glow, cyberpunk tones, neon highlights, modern tech ambiance)
-
-Rules:
-- Ensure images are suitable for IT presentations, product demos, training, technical documentation, and digital transformation campaigns.
-- Stay true to the user’s intent but emphasize a technological and innovative look.
-- Output only the final refined image prompt.
-
-User’s raw prompt:
-"{USER_PROMPT}"
-
-Refined DPEX image prompt:
-""",
-
-    "HR": """
-You are a senior AI prompt engineer creating refined prompts for human resources and workplace-related visuals.
-
-Your job:
-- Transform the raw input into a detailed, professional, and HR-focused image prompt.
-- Expand with contextual details about:
-  • Workplace settings (modern office, meeting rooms, open workspaces, onboarding sessions)
-  • People interactions (interviews, teamwork, training, collaboration, diversity and inclusion)
-  • Themes (employee engagement, professional growth, recruitment, performance evaluation)
-  • Composition (groups in discussion, managers mentoring, collaborative workshops)
-  • Lighting and tone (bright, welcoming, professional, inclusive)
-
-Rules:
-- Ensure images are suitable for HR presentations, recruitment campaigns, internal training, or employee engagement material.
-- Stay true to the user’s intent but emphasize people, culture, and workplace positivity.
-- Output only the final refined image prompt.
-
-User’s raw prompt:
-"{USER_PROMPT}"
-
-Refined HR image prompt:
-""",
-
-    "Business": """
-You are a senior AI prompt engineer creating refined prompts for business and corporate visuals.
-
-Your job:
-- Transform the raw input into a detailed, professional, and business-oriented image prompt.
-- Expand with contextual details about:
-  • Corporate settings (boardrooms, skyscrapers, modern offices, networking events)
-  • Business activities (presentations, negotiations, brainstorming sessions, teamwork)
-  • People (executives, entrepreneurs, consultants, diverse teams, global collaboration)
-  • Tone (professional, ambitious, strategic, innovative)
-  • Composition (formal meetings, handshake deals, conference tables, city skyline backgrounds)
-  • Lighting and atmosphere (clean, modern, premium, professional)
-
-Rules:
-- Ensure images are suitable for corporate branding, investor decks, strategy sessions, or professional reports.
-- Stay true to the user’s intent but emphasize professionalism, ambition, and success.
-- Output only the final refined image prompt.
-
-User’s raw prompt:
-"{USER_PROMPT}"
-
-Refined business image prompt:
-"""
-}
-
-
-STYLE_DESCRIPTIONS = {
-    "None": "No special styling — keep the image natural, faithful to the user’s idea.",
-    "Smart": "A clean, balanced, and polished look. Professional yet neutral, visually appealing without strong artistic bias.",
-    "Cinematic": "Film-style composition with professional lighting. Wide dynamic range, dramatic highlights, storytelling feel.",
-    "Creative": "Playful, imaginative, and experimental. Bold artistic choices, unexpected elements, and expressive color use.",
-    "Bokeh": "Photography style with shallow depth of field. Subject in sharp focus with soft, dreamy, blurred backgrounds.",
-    "Macro": "Extreme close-up photography. High detail, textures visible, shallow focus highlighting minute features.",
-    "Illustration": "Hand-drawn or digitally illustrated style. Clear outlines, stylized shading, expressive and artistic.",
-    "3D Render": "Photorealistic or stylized CGI. Crisp geometry, depth, shadows, and reflective surfaces with realistic rendering.",
-    "Fashion": "High-end editorial photography. Stylish, glamorous poses, bold makeup, controlled lighting, and modern aesthetic.",
-    "Minimalist": "Simple and uncluttered. Few elements, large negative space, flat or muted color palette, clean composition.",
-    "Moody": "Dark, atmospheric, and emotional. Strong shadows, high contrast, deep tones, cinematic ambiance.",
-    "Portrait": "Focus on the subject. Natural skin tones, shallow depth of field, close-up or waist-up framing, studio or natural lighting.",
-    "Stock Photo": "Professional, commercial-quality photo. Neutral subject matter, polished composition, business-friendly aesthetic.",
-    "Vibrant": "Bold, saturated colors. High contrast, energetic mood, eye-catching and lively presentation.",
-    "Pop Art": "Comic-book and pop-art inspired. Bold outlines, halftone patterns, flat vivid colors, high contrast, playful tone.",
-    "Vector": "Flat vector graphics. Smooth shapes, sharp edges, solid fills, and clean scalable style like logos or icons.",
-
-    "Watercolor": "Soft, fluid strokes with delicate blending and washed-out textures. Artistic and dreamy.",
-    "Oil Painting": "Rich, textured brushstrokes. Classic fine art look with deep color blending.",
-    "Charcoal": "Rough, sketchy textures with dark shading. Artistic, raw, dramatic effect.",
-    "Line Art": "Minimal monochrome outlines with clean, bold strokes. No shading, focus on form.",
-
-    "Anime": "Japanese animation style with vibrant colors, clean outlines, expressive features, and stylized proportions.",
-    "Cartoon": "Playful, exaggerated features, simplified shapes, bold outlines, and bright colors.",
-    "Pixel Art": "Retro digital art style. Small, pixel-based visuals resembling old-school video games.",
-
-    "Fantasy Art": "Epic fantasy scenes. Magical elements, mythical creatures, enchanted landscapes.",
-    "Surreal": "Dreamlike, bizarre imagery. Juxtaposes unexpected elements, bending reality.",
-    "Concept Art": "Imaginative, detailed artwork for games or films. Often moody and cinematic.",
-
-    "Cyberpunk": "Futuristic neon city vibes. High contrast, glowing lights, dark tones, sci-fi feel.",
-    "Steampunk": "Retro-futuristic style with gears, brass, Victorian aesthetics, and industrial design.",
-    "Neon Glow": "Bright neon outlines and glowing highlights. Futuristic, nightlife aesthetic.",
-    "Low Poly": "Simplified 3D style using flat geometric shapes and polygons.",
-    "Isometric": "3D look with isometric perspective. Often used for architecture, games, and diagrams.",
-
-    "Vintage": "Old-school, retro tones. Faded colors, film grain, sepia, or retro print feel.",
-    "Graffiti": "Urban street art style with bold colors, spray paint textures, and rebellious tone."
-}
+    st.session_state.edited_images = deque(maxlen=HISTORY_LIMIT)  # [{"original_hash","original_display","edited_path","edited_hash","edited_display","prompt"}]
 
 # ---------------- Helpers ----------------
-def safe_get_enhanced_text(resp):
-    if hasattr(resp, "text") and resp.text:
-        return resp.text
-    if hasattr(resp, "candidates") and resp.candidates:
-        try:
-            return resp.candidates[0].content.parts[0].text
-        except Exception:
-            pass
-    return str(resp)
-
+# Retry transient 429/5xx from Vertex with exponential backoff
+_RETRY = retry.Retry(
+    predicate=retry.if_exception_type(ResourceExhausted, ServiceUnavailable, InternalServerError),
+    initial=1.0,
+    maximum=30.0,
+    multiplier=2.0,
+    deadline=120.0,
+)
 
-def run_edit_flow(edit_prompt, base_bytes, filename):
-    """Run Gemini edit on base_bytes with given edit_prompt, with fallback"""
-    input_image = Part.from_data(mime_type="image/png", data=base_bytes)
+@st.cache_resource
+def _gemini_sem():
+    """Process-wide cap on in-flight Gemini calls so parallel sessions stay under the Vertex quota"""
+    # A module-level semaphore would be rebuilt on every script run and cap nothing
+    return threading.BoundedSemaphore(int(os.getenv("GEMINI_CONCURRENCY", "4")))
+
+
+def _call_gemini(model, contents, **kwargs):
+    """generate_content under the concurrency cap, retried with backoff on 429/5xx"""
+    def _call():
+        # Held per attempt only, so a backing-off call does not block other requests
+        with _gemini_sem():
+            return model.generate_content(contents, **kwargs)
+    return _RETRY(_call)()
+
+
+# A refined prompt is a few sentences; capping its length and sampling keeps the text call short
+_REFINE_CONFIG = {"max_output_tokens": 220, "temperature": 0.4, "top_p": 0.9}
+# Headroom for the "rich, detailed" department templates when the short cap cuts a prompt off
+_REFINE_CONFIG_LONG = {**_REFINE_CONFIG, "max_output_tokens": 1024}
+
+
+# Refined prompts are short strings, so this cache can hold far more entries than the image ones
+@st.cache_data(show_spinner=False, ttl=CACHE_TTL, max_entries=512)
+def _cached_refine(template_key, style_key, raw_prompt):
+    """Refine raw_prompt with the department template and style, cached per input"""
+    _, text_model = get_models()
+    prefix, suffix = REFINEMENT_PARTS[(template_key, style_key)]
+    refinement_prompt = prefix + raw_prompt + suffix
+    text_resp = _call_gemini(text_model, refinement_prompt, generation_config=_REFINE_CONFIG)
+    if is_truncated(text_resp):
+        text_resp = _call_gemini(text_model, refinement_prompt, generation_config=_REFINE_CONFIG_LONG)
+        if is_truncated(text_resp):
+            # Raise instead of returning so a cut-off prompt is neither cached nor used
+            raise ValueError("refined prompt was cut off at the output token limit")
+    return safe_get_enhanced_text(text_resp).strip()
+
+
+@st.cache_data(show_spinner=False, ttl=CACHE_TTL, max_entries=128)
+def _cached_generate(prompt, sample):
+    """Generate one image for prompt; sample keeps the N requested variations distinct"""
+    image_model, _ = get_models()
+    resp = _call_gemini(image_model, [prompt])
+    out_bytes = first_inline(resp)
+    if not out_bytes or not sniff_mime(out_bytes):
+        # Raise instead of returning so empty responses are not cached
+        raise ValueError("Gemini did not return an image.")
+    return out_bytes
+
+
+@st.cache_data(show_spinner=False, ttl=CACHE_TTL, max_entries=128)
+def _cached_edit(prompt, image_hash, sample, _image_bytes):
+    """Edit _image_bytes with prompt; image_hash stands in for the bytes in the cache key"""
+    from vertexai.generative_models import Part
+
+    image_model, _ = get_models()
+    # Uploads are sent in their own format; Gemini reads PNG, JPEG and WebP natively
+    mime_type = sniff_mime(_image_bytes)
+    input_image = Part.from_data(mime_type=mime_type, data=_image_bytes)
 
     # Force Gemini to interpret as edit task
-    edit_instruction = f"Edit the provided image as follows: {edit_prompt}. Always return only the edited image as inline PNG."
-
-    resp = IMAGE_MODEL.generate_content([edit_instruction, input_image])
-
-    out_bytes = None
-    text_fallback = None
-
-    for part in resp.candidates[0].content.parts:
-        if hasattr(part, "inline_data") and part.inline_data.data:
-            out_bytes = part.inline_data.data
-        elif hasattr(part, "text") and part.text:
-            text_fallback = part.text
-
-    if out_bytes:
-        return out_bytes
+    edit_instruction = f"Edit the provided image as follows: {prompt}. Always return only the edited image as inline PNG."
+
+    try:
+        resp = _call_gemini(image_model, [edit_instruction, input_image])
+    except InvalidArgument:
+        if mime_type == "image/png":
+            raise
+        # Lazy fallback: only re-encode to PNG if the model rejects the original format
+        input_image = Part.from_data(mime_type="image/png", data=to_png(_image_bytes))
+        resp = _call_gemini(image_model, [edit_instruction, input_image])
+
+    out_bytes = first_inline(resp)
+    if not out_bytes:
+        # Raise instead of returning so text-only responses are not cached
+        raise ValueError(first_text(resp))
+    if not sniff_mime(out_bytes):
+        raise ValueError("returned data is not a valid image.")
+    return out_bytes
+
+
+@st.cache_data(show_spinner=False, ttl=CACHE_TTL, max_entries=256)
+def _thumb(image_hash, _raw, max_px=PREVIEW_MAX_PX):
+    """Downscaled WEBP preview of _raw for st.image; downloads keep the original bytes"""
+    from PIL import Image
+
+    # Image.open only parses the header; pixels are decoded only to resize or leave PNG
+    with BytesIO(_raw) as src, Image.open(src) as im:
+        if max(im.size) <= max_px and im.format != "PNG":
+            return _raw
+        im.thumbnail((max_px, max_px), Image.LANCZOS)
+        with BytesIO() as buf:
+            im.save(buf, format="WEBP", quality=80)
+            return buf.getvalue()
+
+
+@st.cache_data(show_spinner=False, ttl=CACHE_TTL, max_entries=32)
+def _prepare_upload(image_hash, _raw, max_px=UPLOAD_MAX_PX):
+    """Clamp an upload's long edge to max_px with Lanczos and re-encode it as WEBP for Gemini"""
+    from PIL import Image, ImageOps
+
+    with BytesIO(_raw) as src, Image.open(src) as im:
+        if max(im.size) <= max_px:
+            return _raw
+        # Apply the EXIF rotation first; the re-encoded copy no longer carries the tag
+        im = ImageOps.exif_transpose(im)
+        im.thumbnail((max_px, max_px), Image.LANCZOS)
+        if im.mode not in ("RGB", "RGBA"):
+            im = im.convert("RGBA" if "A" in im.getbands() or "transparency" in im.info else "RGB")
+        with BytesIO() as buf:
+            im.save(buf, format="WEBP", quality=85, method=4)
+            return buf.getvalue()
+
+
+@st.cache_data(show_spinner=False, ttl=CACHE_TTL, max_entries=256)
+def _to_webp(image_hash, _raw, quality=85):
+    """WEBP re-encode of _raw, typically several times smaller than the PNG from Vertex"""
+    from PIL import Image
+
+    with BytesIO(_raw) as src, Image.open(src) as im, BytesIO() as buf:
+        im.save(buf, format="WEBP", quality=quality, method=4)
+        return buf.getvalue()
+
+
+_MIME_EXT = {"image/png": "png", "image/jpeg": "jpg", "image/webp": "webp"}
+
+
+def download_button(label, image_hash, data, filename, key):
+    """Download button serving WEBP by default, or the original bytes when the user opts in"""
+    stem = filename.rsplit(".", 1)[0]
+    if st.session_state.get("download_png"):
+        # The model can return JPEG or WebP too, so label the original by what it really is
+        mime = sniff_mime(data) or "image/png"
+        st.download_button(label, data=data, file_name=f"{stem}.{_MIME_EXT[mime]}", mime=mime, key=key)
     else:
-        if text_fallback:
-            st.warning(f"⚠️ Gemini did not return an image. Response: {text_fallback}")
+        st.download_button(label, data=_to_webp(image_hash, data), file_name=f"{stem}.webp", mime="image/webp", key=key)
+
+
+def image_digest(data):
+    """BLAKE2b digest of image bytes, computed once and used as the cache key for them"""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+@st.cache_resource
+def get_image_dir():
+    """Per-process directory holding full-size history images, removed at exit"""
+    path = Path(tempfile.mkdtemp(prefix="nano_banana_"))
+    atexit.register(shutil.rmtree, path, ignore_errors=True)
+    return path
+
+
+@st.cache_resource
+def _image_store():
+    """Shared state for the image dir: background writer, unwritten bytes and an LRU index
+
+    "pending" maps path -> bytes not yet on disk (a failed write keeps its bytes there as
+    the fallback copy); "index" maps path -> size of files on disk, oldest use first.
+    Both are shared with the writer thread, so they are only touched under "lock".
+    """
+    return {
+        "writer": ThreadPoolExecutor(max_workers=1, thread_name_prefix="image_writer"),
+        "pending": {},
+        "index": OrderedDict(),
+        "bytes": 0,
+        "lock": threading.Lock(),
+    }
+
+
+def _track_file(path, size):
+    """Add a written file to the LRU index and delete the oldest files over IMAGE_DIR_MAX_BYTES"""
+    store = _image_store()
+    evicted = []
+    with store["lock"]:
+        store["pending"].pop(str(path), None)
+        if str(path) not in store["index"]:
+            store["index"][str(path)] = size
+            store["bytes"] += size
+        # Sessions share the dir and end without notice, so it is bounded by size, not by history
+        while store["bytes"] > IMAGE_DIR_MAX_BYTES and len(store["index"]) > 1:
+            old, old_size = store["index"].popitem(last=False)
+            store["bytes"] -= old_size
+            evicted.append(old)
+    for old in evicted:
+        Path(old).unlink(missing_ok=True)
+
+
+def _write_and_prune(path, data):
+    """Writer task: persist data, then prune the image dir back under its cap"""
+    # Write then rename, so a reader never sees a half-written file
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+    _track_file(path, len(data))
+
+
+def store_image(image_hash, data):
+    """Queue data for writing to the image dir under its digest and return the path"""
+    path = str(get_image_dir() / image_hash)
+    store = _image_store()
+    with store["lock"]:
+        if path in store["index"]:
+            store["index"].move_to_end(path)
+            return path
+        if path in store["pending"]:
+            return path
+        store["pending"][path] = data
+    store["writer"].submit(_write_and_prune, Path(path), data)
+    return path
+
+
+def load_image(path):
+    """Full-size image bytes for a history entry, or None if they are no longer available"""
+    store = _image_store()
+    with store["lock"]:
+        data = store["pending"].get(path)
+        if path in store["index"]:
+            store["index"].move_to_end(path)
+    if data is not None:
+        # Still queued, or the write failed: serve the in-memory copy
+        return data
+    try:
+        return Path(path).read_bytes()
+    except OSError:
         return None
 
 
+def _history_zip(entries):
+    """Write (name, path) history images to a ZIP in the image dir and return its path
+
+    Images are streamed into the archive one at a time and the ZIP counts against the
+    image dir's size cap, so it never sits in memory or in session_state.
+    """
+    path = get_image_dir() / f"history_{request_id(*entries)}.zip"
+    if not path.exists():
+        # Per-thread temp name: two sessions with the same history may build it at once
+        tmp = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+        # Images are already compressed, so store them as-is instead of deflating again
+        with zipfile.ZipFile(tmp, "w", zipfile.ZIP_STORED) as zf:
+            for name, img_path in entries:
+                data = load_image(img_path)
+                if data is not None:
+                    zf.writestr(f"{name}.{_MIME_EXT.get(sniff_mime(data), 'png')}", data)
+        os.replace(tmp, path)
+        _track_file(path, path.stat().st_size)
+    return str(path)
+
+
+def add_to_history(history, entry, hash_key):
+    """Append entry unless history already holds the same image; hashes double as widget keys"""
+    if all(e[hash_key] != entry[hash_key] for e in history):
+        history.append(entry)
+
+
+def request_id(*parts):
+    """Short digest of a submit's inputs, used to drop repeated submits of identical requests"""
+    return hashlib.blake2b("|".join(map(str, parts)).encode(), digest_size=16).hexdigest()
+
+
+@st.cache_resource(show_spinner=False)
+def _warm_image_model():
+    """Open the image model's connection once per process with a cheap count_tokens RPC"""
+    image_model, _ = get_models()
+    try:
+        image_model.count_tokens("warm-up")
+    except Exception:
+        pass  # best effort; the real request will surface any error
+    return True
+
+
+@st.cache_resource
+def _warmup_pool():
+    """Single background thread for the image-model warm-up, shared by all sessions"""
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="warmup")
+
+
+def refine_prompt(dept, style, raw_prompt, skip=False):
+    """Enhanced prompt for the inputs; skip builds it locally without calling the text model"""
+    # Whitespace does not change the refinement, so collapse it before it keys the cache.
+    # Case is kept: it can matter for names and for text the image should contain.
+    raw_prompt = " ".join(raw_prompt.split())
+    if skip:
+        return raw_prompt + STYLE_HINT[style]
+    # Repeat clicks with unchanged inputs reuse the last result without touching the cache
+    refine_key = (dept, style, raw_prompt)
+    if st.session_state.get("last_refine_key") == refine_key:
+        return st.session_state.last_refine_val
+    # Hide the image endpoint's connection setup behind the text-model round-trip;
+    # not waited on, so a slow warm-up never delays the refined prompt
+    _warmup_pool().submit(_warm_image_model)
+    try:
+        enhanced_prompt = _cached_refine(dept, style, raw_prompt)
+    except ValueError:
+        st.warning("⚠️ Prompt refinement was cut off, so your prompt is used as written.")
+        return raw_prompt + STYLE_HINT[style]
+    st.session_state.last_refine_key = refine_key
+    st.session_state.last_refine_val = enhanced_prompt
+    return enhanced_prompt
+
+
+@st.cache_data(show_spinner=False, ttl=CACHE_TTL, max_entries=128)
+def _cached_generate_batch(prompt, num_images):
+    """Generate num_images candidates for prompt in a single request"""
+    from vertexai.generative_models import GenerationConfig
+
+    image_model, _ = get_models()
+    resp = _call_gemini(image_model, [prompt], generation_config=GenerationConfig(candidate_count=num_images))
+    raws = [blob for blob in inline_per_candidate(resp) if sniff_mime(blob)]
+    if not raws:
+        # Raise instead of returning so empty responses are not cached
+        raise ValueError("Gemini did not return an image.")
+    return raws
+
+
+@st.cache_resource
+def _batch_support():
+    """Process-wide flag: does the image model accept candidate_count > 1"""
+    return {"supported": True}
+
+
+def generate_images(prompt, num_images):
+    """Yield (image, error) pairs for num_images images of prompt as each one completes
+
+    Tries one request with candidate_count first. If the model rejects candidate_count,
+    that is remembered for the process and the images are requested in parallel instead.
+    A batch that comes back short is topped up the same way.
+    """
+    first = 0
+    batch_error = None
+    batch = _batch_support()
+    if num_images > 1 and batch["supported"]:
+        try:
+            blobs = _cached_generate_batch(prompt, num_images)[:num_images]
+        except InvalidArgument as e:
+            if "candidate" in str(e).lower():
+                batch["supported"] = False
+            else:
+                # Could be the prompt itself; only blamed on batching if single calls then work
+                batch_error = e
+        except ValueError:
+            pass
+        except Exception as e:
+            # Quota exhausted past the retry deadline, auth or network: single calls would fail too
+            yield None, e
+            return
+        else:
+            for blob in blobs:
+                yield blob, None
+            # candidate_count is an upper bound; request any missing images one by one
+            first = len(blobs)
+
+    samples = range(first, num_images)
+    if not samples:
+        return
+    with ThreadPoolExecutor(max_workers=len(samples)) as pool:
+        futures = [pool.submit(_cached_generate, prompt, i) for i in samples]
+        for future in as_completed(futures):
+            try:
+                blob = future.result()
+            except Exception as e:
+                yield None, e
+                continue
+            if batch_error is not None:
+                # The same prompt works one image at a time, so candidate_count was rejected
+                batch["supported"] = False
+                batch_error = None
+            yield blob, None
+
+
+def run_edit_flow(edit_prompt, base_bytes, image_hash, num_images=1):
+    """Run num_images Gemini edits on base_bytes in parallel, returning (images, problems)
+
+    problems holds one ("warning" | "error", message) pair per failed variation, for the
+    caller to show from the script thread; worker threads cannot write Streamlit elements.
+    """
+    with ThreadPoolExecutor(max_workers=num_images) as pool:
+        futures = [pool.submit(_cached_edit, edit_prompt, image_hash, i, base_bytes) for i in range(num_images)]
+
+    edited, problems = [], []
+    for i, future in enumerate(futures):
+        try:
+            edited.append(future.result())
+        except ValueError as e:
+            detail = f" Response: {e.args[0]}" if e.args and e.args[0] else ""
+            problems.append(("warning", f"⚠️ Variation {i+1}: Gemini did not return an image.{detail}"))
+        except Exception as e:
+            problems.append(("error", f"⚠️ Variation {i+1}: Image editing error: {e}"))
+    return edited, problems
+
+
 # ---------------- TABS ----------------
 tab_generate, tab_edit = st.tabs(["✨ Generate Images", "🖌️ Edit Images"])
 
@@ -278,121 +477,239 @@ tab_generate, tab_edit = st.tabs(["✨ Generate Images", "🖌️ Edit Images"])
 with tab_generate:
     st.header("✨ Generate Images ")
 
-    dept_gen = st.selectbox("🏢 Department", options=list(PROMPT_TEMPLATES.keys()), index=2, key="dept_gen")
-    style_gen = st.selectbox("🎨 Style", options=list(STYLE_DESCRIPTIONS.keys()), index=0, key="style_gen")
-    raw_prompt_gen = st.text_area("Enter your prompt", height=120, key="prompt_gen")
-    num_images = st.slider("🧾 Number of images", 1, 4, 1, key="num_gen")
-
-    if st.button("🚀 Generate", key="gen_btn"):
+    # A form batches the inputs, so editing them does not rerun the script until submit
+    with st.form("gen_form"):
+        dept_gen = st.selectbox("🏢 Department", options=_DEPT_OPTS, index=2, key="dept_gen")
+        style_gen = st.selectbox("🎨 Style", options=_STYLE_OPTS, index=0, key="style_gen")
+        raw_prompt_gen = st.text_area("Enter your prompt", height=120, key="prompt_gen")
+        num_images = st.slider("🧾 Number of images", 1, 4, 1, key="num_gen")
+        fast_gen = st.checkbox("⚡ Fast mode (skip prompt refinement)", key="fast_gen")
+        gen_submitted = st.form_submit_button("🚀 Generate")
+
+    if gen_submitted:
+        gen_req_id = request_id(dept_gen, style_gen, raw_prompt_gen, num_images, fast_gen)
         if not raw_prompt_gen.strip():
             st.warning("Please enter a prompt.")
+        elif st.session_state.get("last_gen_req_id") == gen_req_id:
+            st.info("These inputs were just generated — see the results in History below.")
         else:
-            with st.spinner("Refining prompt with Gemini..."):
-                refinement_prompt = PROMPT_TEMPLATES[dept_gen].replace("{USER_PROMPT}", raw_prompt_gen)
-                if style_gen != "None":
-                    refinement_prompt += f"\n\nApply the style: {STYLE_DESCRIPTIONS[style_gen]}"
-                text_resp = TEXT_MODEL.generate_content(refinement_prompt)
-                enhanced_prompt = safe_get_enhanced_text(text_resp).strip()
+            with st.spinner("Preparing prompt..." if fast_gen else "Refining prompt with Gemini..."):
+                enhanced_prompt = refine_prompt(dept_gen, style_gen, raw_prompt_gen, skip=fast_gen)
                 st.info(f"🔮 Enhanced Prompt:\n\n{enhanced_prompt}")
 
+            # One timestamp per submit; the session counter keeps names unique across batches
+            stamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
             with st.spinner("Generating images with Nano Banana..."):
-                generated_raws = []
-                try:
-                    for i in range(num_images):
-                        resp = IMAGE_MODEL.generate_content([enhanced_prompt])
-                        for part in resp.candidates[0].content.parts:
-                            if hasattr(part, "inline_data") and part.inline_data.data:
-                                generated_raws.append(part.inline_data.data)
-                except Exception as e:
-                    st.error(f"⚠️ Image generation error: {e}")
-
-                if generated_raws:
-                    for idx, img_bytes in enumerate(generated_raws):
-                        filename = f"{dept_gen.lower()}_{style_gen.lower()}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}_{idx}.png"
-                        st.session_state.generated_images.append({"filename": filename, "content": img_bytes})
+                # Each image is drawn as soon as it arrives instead of after the slowest one
+                for idx, (img_bytes, err) in enumerate(generate_images(enhanced_prompt, num_images)):
+                    if err is not None:
+                        st.error(f"⚠️ Image generation error: {err}")
+                        continue
+
+                    st.session_state.last_gen_req_id = gen_req_id
+                    st.session_state.img_seq = st.session_state.get("img_seq", 0) + 1
+                    filename = f"{dept_gen.lower()}_{style_gen.lower()}_{stamp}_{st.session_state.img_seq:04d}.png"
+                    img_hash = image_digest(img_bytes)
+                    display = _thumb(img_hash, img_bytes)  # WEBP preview, encoded once at ingest
+                    add_to_history(
+                        st.session_state.generated_images,
+                        {"filename": filename, "path": store_image(img_hash, img_bytes), "hash": img_hash, "display": display},
+                        "hash",
+                    )
 
-                        st.image(Image.open(BytesIO(img_bytes)), caption=filename, use_column_width=True)
-                        st.download_button("⬇️ Download", data=img_bytes, file_name=filename, mime="image/png", key=f"dl_{idx}")
+                    st.image(display, caption=filename, use_column_width=True)
+                    download_button("⬇️ Download", img_hash, img_bytes, filename, key=f"dl_{idx}")
 
 
 # ---------------- EDIT MODE ----------------
-with tab_edit:
+@st.fragment
+def _edit_tab():
+    """Upload-and-edit section; as a fragment its widgets rerun only this block, not the whole page"""
     st.header("🖌️ Edit Uploaded Images")
 
     uploaded_file = st.file_uploader("📤 Upload an image", type=["png", "jpg", "jpeg", "webp"])
+    preview = st.empty()
     base_image = None
     if uploaded_file:
-        image_bytes = uploaded_file.read()
-        mime_type = "image/" + uploaded_file.type.split("/")[-1]
-        if mime_type == "image/webp":  # ✅ Convert WebP → PNG
-            img = Image.open(BytesIO(image_bytes)).convert("RGB")
-            buf = BytesIO()
-            img.save(buf, format="PNG")
-            image_bytes = buf.getvalue()
-        base_image = image_bytes
-
-    dept_edit = st.selectbox("🏢 Department", options=list(PROMPT_TEMPLATES.keys()), index=2, key="dept_edit")
-    style_edit = st.selectbox("🎨 Style", options=list(STYLE_DESCRIPTIONS.keys()), index=0, key="style_edit")
-    raw_prompt_edit = st.text_area("Enter your edit instruction", height=120, key="prompt_edit")
-    num_edit_images = st.slider("🧾 Number of edited images", 1, 4, 1, key="num_edit")
-
-    if st.button("🚀 Edit Image", key="edit_btn_upload"):
+        # getvalue() ignores the read cursor, so reruns never see an empty buffer
+        image_bytes = uploaded_file.getvalue()
+        uploaded_file.seek(0)
+        upload_hash = image_digest(image_bytes)
+        if st.session_state.get("last_upload_hash") == upload_hash:
+            # Same upload as the previous rerun: reuse the already prepared bytes
+            base_image = st.session_state.last_upload_bytes
+        else:
+            # Trust the file signature, not the browser-reported type
+            mime_type = sniff_mime(image_bytes)
+            if mime_type is None:
+                st.error("⚠️ The uploaded file is not a valid PNG, JPEG or WebP image.")
+            else:
+                image_bytes = _prepare_upload(upload_hash, image_bytes)
+                # Results of the previous upload's edit no longer apply
+                st.session_state.pop("last_edit_results", None)
+                st.session_state.last_upload_hash = upload_hash
+                st.session_state.last_upload_bytes = image_bytes
+                base_image = image_bytes
+        del image_bytes
+        if base_image:
+            # Reuse one placeholder so reruns update the same element instead of adding a new one
+            preview.image(_thumb(upload_hash, base_image), caption="Uploaded image", use_column_width=True)
+
+    # The uploader stays outside the form so its preview still updates on upload
+    with st.form("edit_form"):
+        dept_edit = st.selectbox("🏢 Department", options=_DEPT_OPTS, index=2, key="dept_edit")
+        style_edit = st.selectbox("🎨 Style", options=_STYLE_OPTS, index=0, key="style_edit")
+        raw_prompt_edit = st.text_area("Enter your edit instruction", height=120, key="prompt_edit")
+        num_edit_images = st.slider("🧾 Number of edited images", 1, 4, 1, key="num_edit")
+        skip_refine_edit = st.checkbox("⚡ Skip refinement (send the instruction as-is)", key="skip_refine_edit")
+        edit_submitted = st.form_submit_button("🚀 Edit Image")
+
+    if not uploaded_file:
+        st.session_state.pop("last_edit_results", None)
+
+    if edit_submitted:
+        # Every submit replaces what is shown below, so stale results never pose as new ones
+        st.session_state.pop("last_edit_results", None)
+        edit_req_id = request_id(
+            dept_edit, style_edit, raw_prompt_edit, num_edit_images, skip_refine_edit,
+            st.session_state.get("last_upload_hash"),
+        )
         if not base_image or not raw_prompt_edit.strip():
             st.warning("Please upload an image and enter an instruction.")
+        elif st.session_state.get("last_edit_req_id") == edit_req_id:
+            st.info("This edit was just applied — its results are saved in History.")
         else:
-            with st.spinner("Refining edit instruction with Gemini..."):
-                refinement_prompt = PROMPT_TEMPLATES[dept_edit].replace("{USER_PROMPT}", raw_prompt_edit)
-                if style_edit != "None":
-                    refinement_prompt += f"\n\nApply the style: {STYLE_DESCRIPTIONS[style_edit]}"
-                text_resp = TEXT_MODEL.generate_content(refinement_prompt)
-                enhanced_prompt = safe_get_enhanced_text(text_resp).strip()
-                st.info(f"🔮 Enhanced Instruction:\n\n{enhanced_prompt}")
+            prompt_box = st.empty()
+            with st.spinner("Preparing edit instruction..." if skip_refine_edit else "Refining edit instruction with Gemini..."):
+                enhanced_prompt = refine_prompt(dept_edit, style_edit, raw_prompt_edit, skip=skip_refine_edit)
+                prompt_box.info(f"🔮 Enhanced Instruction:\n\n{enhanced_prompt}")
 
             with st.spinner("Editing image with Nano Banana..."):
-                edited_versions = []
-                for i in range(num_edit_images):
-                    out_bytes = run_edit_flow(
-                        enhanced_prompt,
-                        base_image,
-                        f"edit_{datetime.datetime.now().strftime('%H%M%S')}_{i}"
-                    )
-                    if out_bytes:
-                        edited_versions.append(out_bytes)
-
-                if edited_versions:
-                    cols = st.columns(len(edited_versions))
-                    for i, out_bytes in enumerate(edited_versions):
-                        with cols[i]:
-                            st.image(Image.open(BytesIO(out_bytes)), caption=f"Edited Version {i+1}", use_column_width=True)
-                            st.download_button(
-                                f"⬇️ Download Edited {i+1}",
-                                data=out_bytes,
-                                file_name=f"edited_{i}.png",
-                                mime="image/png",
-                                key=f"edit_download_{i}"
-                            )
-                            st.session_state.edited_images.append({
-                                "original": base_image,
-                                "edited": out_bytes,
-                                "prompt": enhanced_prompt
-                            })
+                edited_versions, problems = run_edit_flow(enhanced_prompt, base_image, upload_hash, num_images=num_edit_images)
+            prompt_box.empty()
+
+            applied = bool(edited_versions)
+            entries = []
+            if applied:
+                st.session_state.last_edit_req_id = edit_req_id
+                original_display = _thumb(upload_hash, base_image, COLUMN_PREVIEW_MAX_PX)
+                for out_bytes in edited_versions:
+                    out_hash = image_digest(out_bytes)
+                    entry = {
+                        "original_hash": upload_hash,
+                        "original_display": original_display,
+                        "edited_path": store_image(out_hash, out_bytes),
+                        "edited_hash": out_hash,
+                        "edited_display": _thumb(out_hash, out_bytes, COLUMN_PREVIEW_MAX_PX),
+                        "prompt": enhanced_prompt
+                    }
+                    add_to_history(st.session_state.edited_images, entry, "edited_hash")
+                    entries.append(entry)
+            st.session_state.last_edit_results = {"prompt": enhanced_prompt, "entries": entries, "problems": problems}
+
+            # Release the per-request image buffers now instead of on the next GC cycle
+            del edited_versions
+            gc.collect()
+            if applied:
+                # History is its own fragment and would not see the new entries until the
+                # next full rerun; the results below are re-drawn from session_state
+                st.rerun(scope="app")
+
+    # Results of the last edit, kept in session_state so they survive the rerun above
+    last_edit = st.session_state.get("last_edit_results")
+    if last_edit:
+        st.info(f"🔮 Enhanced Instruction:\n\n{last_edit['prompt']}")
+        for level, message in last_edit["problems"]:
+            if level == "warning":
+                st.warning(message)
+            else:
+                st.error(message)
+        if last_edit["entries"]:
+            cols = st.columns(len(last_edit["entries"]))
+            for i, entry in enumerate(last_edit["entries"]):
+                with cols[i]:
+                    st.image(entry["edited_display"], caption=f"Edited Version {i+1}", use_column_width=True)
+                    full = load_image(entry["edited_path"])
+                    if full is not None:
+                        download_button(
+                            f"⬇️ Download Edited {i+1}",
+                            entry["edited_hash"],
+                            full,
+                            f"edited_{i}.png",
+                            key=f"edit_download_{i}"
+                        )
+
+with tab_edit:
+    _edit_tab()
 
 # ---------------- HISTORY ----------------
-st.subheader("📂 History")
-if st.session_state.generated_images:
-    st.markdown("### Generated Images")
-    for i, img in enumerate(reversed(st.session_state.generated_images[-20:])):
-        with st.expander(f"Generated {i+1}: {img['filename']}"):
-            st.image(Image.open(BytesIO(img["content"])), caption=img["filename"], use_column_width=True)
-            st.download_button("⬇️ Download Again", data=img["content"], file_name=img["filename"], mime="image/png", key=f"gen_hist_{i}")
-
-if st.session_state.edited_images:
-    st.markdown("### Edited Images")
-    for i, entry in enumerate(reversed(st.session_state.edited_images[-20:])):
-        with st.expander(f"Edited {i+1}: {entry['prompt']}"):
-            col1, col2 = st.columns(2)
-            with col1:
-                st.image(Image.open(BytesIO(entry["original"])), caption="Original", use_column_width=True)
-            with col2:
-                st.image(Image.open(BytesIO(entry["edited"])), caption="Edited", use_column_width=True)
-            st.download_button("⬇️ Download Edited", data=entry["edited"], file_name=f"edited_{i}.png", mime="image/png", key=f"edit_hist_{i}")
+def _next_history_page():
+    """Reveal the next HISTORY_PAGE_SIZE entries of each history list"""
+    st.session_state.history_page = st.session_state.get("history_page", 1) + 1
+
+
+@st.fragment
+def render_history():
+    """History section; as a fragment its widgets rerun only this block, not the whole page"""
+    st.subheader("📂 History")
+    zip_entries = tuple(
+        [(f"generated/{img['filename'].rsplit('.', 1)[0]}", img["path"]) for img in st.session_state.generated_images]
+        + [(f"edited/edited_{e['edited_hash'][:12]}", e["edited_path"]) for e in st.session_state.edited_images]
+    )
+    # The ZIP reads every full image, so it is only built on request; session_state keeps
+    # just its path on disk, for as long as the history it was built from is unchanged
+    ready = st.session_state.get("history_zip_ready")
+    zip_bytes = None
+    if ready and ready[0] == zip_entries:
+        zip_bytes = load_image(ready[1])
+    if zip_bytes is None:
+        st.session_state.pop("history_zip_ready", None)
+        if zip_entries and st.button("🗜️ Prepare ZIP of all images", key="history_zip_prepare"):
+            with st.spinner("Building ZIP..."):
+                zip_path = _history_zip(zip_entries)
+            st.session_state.history_zip_ready = (zip_entries, zip_path)
+            zip_bytes = load_image(zip_path)
+    if zip_bytes is not None:
+        st.download_button(
+            "⬇️ Download all (ZIP)",
+            data=zip_bytes,
+            file_name="history.zip",
+            mime="application/zip",
+            key="history_zip_download",
+        )
+    # Only the newest pages are rendered; older entries wait behind "Load more"
+    shown = st.session_state.get("history_page", 1) * HISTORY_PAGE_SIZE
+    if st.session_state.generated_images:
+        st.markdown("### Generated Images")
+        for i, img in enumerate(islice(reversed(st.session_state.generated_images), shown)):
+            # Collapsed entries cost one toggle; only open ones build a preview and download
+            if st.toggle(f"Generated {i+1}: {img['filename']}", key=f"gen_hist_open_{img['hash']}"):
+                with st.container(border=True):
+                    st.image(img["display"], caption=img["filename"], use_column_width=True)
+                    full = load_image(img["path"])
+                    if full is None:
+                        st.caption("⚠️ The full-size image is no longer available.")
+                    else:
+                        download_button("⬇️ Download Again", img["hash"], full, img["filename"], key=f"gen_hist_{img['hash']}")
+
+    if st.session_state.edited_images:
+        st.markdown("### Edited Images")
+        for i, entry in enumerate(islice(reversed(st.session_state.edited_images), shown)):
+            if st.toggle(f"Edited {i+1}: {entry['prompt']}", key=f"edit_hist_open_{entry['edited_hash']}"):
+                with st.container(border=True):
+                    col1, col2 = st.columns(2)
+                    with col1:
+                        st.image(entry["original_display"], caption="Original", use_column_width=True)
+                    with col2:
+                        st.image(entry["edited_display"], caption="Edited", use_column_width=True)
+                    full = load_image(entry["edited_path"])
+                    if full is None:
+                        st.caption("⚠️ The full-size image is no longer available.")
+                    else:
+                        download_button("⬇️ Download Edited", entry["edited_hash"], full, f"edited_{i}.png", key=f"edit_hist_{entry['edited_hash']}")
+
+    if max(len(st.session_state.generated_images), len(st.session_state.edited_images)) > shown:
+        st.button("Load more", key="history_load_more", on_click=_next_history_page)
+
+
+render_history()
@@ -0,0 +1,102 @@
+from io import BytesIO
+
+# ---------------- Gemini I/O helpers ----------------
+PNG_SIG = b"\x89PNG\r\n\x1a\n"
+JPEG_SIG = b"\xff\xd8\xff"
+
+
+def sniff_mime(data):
+    """Image mime type from the leading magic bytes, or None if data is not a supported image"""
+    if data.startswith(PNG_SIG):
+        return "image/png"
+    if data.startswith(JPEG_SIG):
+        return "image/jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+def safe_get_enhanced_text(resp):
+    # EAFP: one attribute access per step instead of hasattr probing each proto field twice
+    try:
+        text = resp.text
+        if text:
+            return text
+    except Exception:
+        pass
+    try:
+        return resp.candidates[0].content.parts[0].text
+    except Exception:
+        return str(resp)
+
+
+def is_truncated(resp):
+    """True if the first candidate stopped because it hit max_output_tokens"""
+    try:
+        return resp.candidates[0].finish_reason.name == "MAX_TOKENS"
+    except (AttributeError, IndexError):
+        return False
+
+
+def to_png(data):
+    """Re-encode image bytes as PNG"""
+    from PIL import Image  # only needed on the rare format-fallback path
+
+    with BytesIO(data) as src, Image.open(src) as img, BytesIO() as buf:
+        # Throwaway API payload: fastest deflate level, size barely matters here
+        img.convert("RGB").save(buf, format="PNG", compress_level=1)
+        return buf.getvalue()
+
+
+def part_kind(part):
+    """Name of the field set in the Part's `data` oneof ("text", "inline_data", ...), or None"""
+    # vertexai Parts wrap a proto-plus message; WhichOneof is one C-level check and never
+    # allocates the default message that touching an unset oneof field would
+    raw = getattr(part, "_raw_part", part)
+    pb = getattr(raw, "_pb", None)
+    if pb is not None:
+        return pb.WhichOneof("data")
+    if getattr(getattr(part, "inline_data", None), "data", None):
+        return "inline_data"
+    if getattr(part, "text", None):
+        return "text"
+    return None
+
+
+def first_inline(resp):
+    """First inline image blob across all candidates, or None"""
+    return next(
+        (
+            part.inline_data.data
+            for cand in resp.candidates
+            for part in cand.content.parts
+            if part_kind(part) == "inline_data" and part.inline_data.data
+        ),
+        None,
+    )
+
+
+def inline_per_candidate(resp):
+    """First inline image blob of each candidate that has one"""
+    blobs = []
+    for cand in resp.candidates:
+        blob = next(
+            (part.inline_data.data for part in cand.content.parts if part_kind(part) == "inline_data" and part.inline_data.data),
+            None,
+        )
+        if blob:
+            blobs.append(blob)
+    return blobs
+
+
+def first_text(resp):
+    """First non-empty text part across all candidates, or None"""
+    return next(
+        (
+            part.text
+            for cand in resp.candidates
+            for part in cand.content.parts
+            if part_kind(part) == "text" and part.text
+        ),
+        None,
+    )